@@ -1,6 +1,14 @@
 import asyncio
+import re
 from crawl4ai import AsyncWebCrawler
 
+CSRF_TOKEN_RE = re.compile(r'name="_csrf"[^>]*content="([^"]*)"')
+FORM_ACTION_RE = re.compile(r'action="([^"]*)"')
+
+def save_html(path, html):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html)
+
 async def debug_login_page():
     """
     Debug the login page to see what we're working with
@@ -22,8 +30,7 @@ async def debug_login_page():
             if '_csrf' in html:
                 print("✅ CSRF token found in page")
                 # Find CSRF token value
-                import re
-                csrf_match = re.search(r'name="_csrf"[^>]*content="([^"]*)"', html)
+                csrf_match = CSRF_TOKEN_RE.search(html)
                 if csrf_match:
                     print(f"CSRF Token: {csrf_match.group(1)}")
             else:
@@ -47,12 +54,11 @@ async def debug_login_page():
             
             # Check for any form action URLs
             if 'action=' in html:
-                form_actions = re.findall(r'action="([^"]*)"', html)
+                form_actions = FORM_ACTION_RE.findall(html)
                 print(f"Form actions found: {form_actions}")
             
-            # Save the HTML for manual inspection
-            with open('login_page_debug.html', 'w', encoding='utf-8') as f:
-                f.write(html)
+            # Save the HTML for manual inspection (off the event loop, the page is large)
+            await asyncio.to_thread(save_html, 'login_page_debug.html', html)
             print("💾 Full HTML saved to login_page_debug.html for inspection")
             
         else:
@@ -1,17 +1,59 @@
 import asyncio
-import json
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import List, Optional
-import openai
+from typing import Callable, List, Optional
+import numpy as np
 import os
+import re
 from dotenv import load_dotenv
-from shufersal_crawler_service import shopping_flow
 from playwright.async_api import async_playwright
+from shufersal_crawler_service import (
+    shopping_flow, get_openai_client, get_http_client, prefetch_search, build_search_term,
+    StreamingArrayParser, HEADLESS, BROWSER_ARGS
+)
 
 load_dotenv()
 
-app = FastAPI()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start Playwright and Chromium once and share the browser across /shop requests
+    """
+    playwright = await async_playwright().start()
+    app.state.playwright = playwright
+    app.state.browser = await playwright.chromium.launch(headless=HEADLESS, args=BROWSER_ARGS)
+    app.state.browser_lock = asyncio.Lock()
+    try:
+        yield
+    finally:
+        await app.state.browser.close()
+        await playwright.stop()
+        await get_http_client().aclose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+async def get_shared_browser():
+    """
+    Return the shared browser, relaunching it if Chromium crashed or disconnected
+    """
+    if app.state.browser.is_connected():
+        return app.state.browser
+
+    async with app.state.browser_lock:
+        # Another request may have relaunched it while this one waited
+        if not app.state.browser.is_connected():
+            logger.warning("Shared browser disconnected, relaunching Chromium")
+            app.state.browser = await app.state.playwright.chromium.launch(headless=HEADLESS, args=BROWSER_ARGS)
+        return app.state.browser
 
 class ShoppingItem(BaseModel):
     product_name: str
@@ -36,13 +78,10 @@ class ShopResponse(BaseModel):
     success: bool
     message: str
 
-# Configure OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
-
 SHOPPING_PARSER_PROMPT = """
 You are a shopping expert AI that parses Hebrew shopping requests into structured JSON.
 
-Your task is to parse shopping requests in Hebrew and return a JSON list of products.
+Your task is to parse shopping requests in Hebrew and return a JSON object with an "items" list of products.
 
 For each product, extract:
 - product_name: The main product (e.g., "מעדן חלבון", "מלפפון", "חלב")
@@ -59,109 +98,316 @@ For each product, extract:
 
 Examples:
 Input: "מעדן חלבון גו טעם וניל 8 כאלה"
-Output: [{"product_name": "מעדן חלבון", "brand": "גו", "quantity": 8, "unit": "pieces", "preferences": "טעם וניל"}]
+Output: {"items": [{"product_name": "מעדן חלבון", "brand": "גו", "quantity": 8, "unit": "pieces", "preferences": "טעם וניל"}]}
 
 Input: "מלפפון 2 קילו וגם חלב תנובה 3 ליטר 1%"
-Output: [
+Output: {"items": [
   {"product_name": "מלפפון", "brand": null, "quantity": 2, "unit": "kg", "preferences": null},
-  {"product_name": "חלב", "brand": "תנובה", "quantity": 3, "unit": "liters", "preferences": 1%}
-]
+  {"product_name": "חלב", "brand": "תנובה", "quantity": 3, "unit": "liters", "preferences": "1%"}
+]}
 
 Input: "עגבניות 500 גרם אורגני ולחם שחור 2 כיכרות"
-Output: [
+Output: {"items": [
   {"product_name": "עגבניות", "brand": null, "quantity": 500, "unit": "grams", "preferences": "אורגני"},
   {"product_name": "לחם שחור", "brand": null, "quantity": 2, "unit": "pieces", "preferences": null}
-]
+]}
+
+Input: "מלפפון חצי קילו, גבינה צהובה במשקל 200 גרם"
+Output: {"items": [
+  {"product_name": "מלפפון", "brand": null, "quantity": 0.5, "unit": "kg", "preferences": null},
+  {"product_name": "גבינה צהובה", "brand": null, "quantity": 200, "unit": "grams", "preferences": "במשקל"}
+]}
+
+Input: "ביסלי בצל שקית קטנה 3 וגם קוקה קולה זירו 6 בקבוקים של ליטר וחצי"
+Output: {"items": [
+  {"product_name": "ביסלי", "brand": null, "quantity": 3, "unit": "pieces", "preferences": "טעם בצל, שקית קטנה"},
+  {"product_name": "זירו", "brand": "קוקה קולה", "quantity": 6, "unit": "pieces", "preferences": "בקבוק 1.5 ליטר"}
+]}
+
+Input: "יוגורט יופלה תות 4, ביצים L תריסר, שמן זית"
+Output: {"items": [
+  {"product_name": "יוגורט", "brand": "יופלה", "quantity": 4, "unit": "pieces", "preferences": "טעם תות"},
+  {"product_name": "ביצים", "brand": null, "quantity": 12, "unit": "pieces", "preferences": "גודל L"},
+  {"product_name": "שמן זית", "brand": null, "quantity": 1, "unit": "pieces", "preferences": null}
+]}
+
+Input: "קפה עלית טורקי 2 חבילות וגם חלב סויה אלפרו בלי סוכר ליטר"
+Output: {"items": [
+  {"product_name": "קפה טורקי", "brand": "עלית", "quantity": 2, "unit": "pieces", "preferences": null},
+  {"product_name": "חלב סויה", "brand": "אלפרו", "quantity": 1, "unit": "liters", "preferences": "ללא סוכר"}
+]}
 
-Return ONLY valid JSON array, no other text.
+Return ONLY a valid JSON object of the form {"items": [...]}, exactly as in the examples, no other text.
 """
 
-async def parse_shopping_list(items_text: str) -> List[ShoppingItem]:
+# Local fast path: simple "<name> [<number> [<unit>]]" lines are parsed without the LLM
+UNIT_WORDS = {
+    "קילו": "kg",
+    "ק\"ג": "kg",
+    "ק״ג": "kg",
+    "קג": "kg",
+    "גרם": "grams",
+    "גרמים": "grams",
+    "ליטר": "liters",
+    "ליטרים": "liters",
+    "מ\"ל": "ml",
+    "מ״ל": "ml",
+    "יחידות": "pieces",
+    "יחידה": "pieces",
+    "חבילות": "pieces",
+    "חבילה": "pieces",
+    "קופסה": "pieces",
+    "קופסאות": "pieces",
+    "בקבוק": "pieces",
+    "בקבוקים": "pieces",
+    "כיכר": "pieces",
+    "כיכרות": "pieces",
+    "שקית": "pieces",
+    "שקיות": "pieces",
+}
+
+HEBREW_QUANTITIES = {"שני שליש": 2 / 3, "חצי": 0.5, "רבע": 0.25, "שליש": 1 / 3}
+
+KNOWN_BRANDS = {"תנובה", "שטראוס", "גו", "עלית", "אסם", "טרה", "יטבתה", "תלמה", "עמק"}
+
+QUANTITY_TOKEN_RE = re.compile(r"\d+(?:\.\d+)?|" + "|".join(HEBREW_QUANTITIES))
+# Quantities first so "שני שליש" and "1.5" stay single tokens
+SIGNATURE_TOKEN_RE = re.compile(QUANTITY_TOKEN_RE.pattern + r"|[^\s\d,]+")
+# Longest product name (in words) the fast parser trusts as a single item
+FAST_PARSE_MAX_NAME_WORDS = 3
+ITEM_SEPARATOR_RE = re.compile(r"[\n,]+|\s+וגם\s+")
+ITEM_LINE_RE = re.compile(
+    r"(?P<name>[\u05D0-\u05EA\s]+?)"
+    r"(?:\s+(?:(?P<qty>\d+(?:\.\d+)?)|(?P<qty_word>" + "|".join(HEBREW_QUANTITIES) + r"))"
+    r"(?:\s*(?P<unit>\S+))?)?"
+)
+
+
+# Exact-match cache of LLM parses, keyed by the stripped input text
+PARSE_CACHE_MAX_SIZE = 256
+_parse_cache = {}
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+
+
+class SemanticParseCache:
     """
-    Use OpenAI to parse shopping list text into structured items
+    Reuse LLM parses for near-identical shopping lists by embedding similarity
+    """
+
+    def __init__(self, threshold, max_size):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.embeddings = None  # one normalized embedding per row
+        self.entries = []  # (list signature, parsed items), aligned with the rows
+
+    def lookup(self, embedding, signature):
+        if not self.entries:
+            return None
+
+        scores = self.embeddings @ embedding
+        best = int(np.argmax(scores))
+        stored_signature, items = self.entries[best]
+        # "חלב 2" and "חלב 3" embed almost identically, so the signatures must match exactly
+        if scores[best] >= self.threshold and stored_signature == signature:
+            return items
+        return None
+
+    def add(self, embedding, signature, items):
+        if self.embeddings is None:
+            self.embeddings = embedding[np.newaxis, :]
+        else:
+            self.embeddings = np.vstack([self.embeddings, embedding])
+        self.entries.append((signature, items))
+
+        if len(self.entries) > self.max_size:
+            self.embeddings = self.embeddings[1:]
+            self.entries.pop(0)
+
+
+semantic_parse_cache = SemanticParseCache(SEMANTIC_CACHE_THRESHOLD, PARSE_CACHE_MAX_SIZE)
+
+
+def shopping_list_signature(text):
+    """
+    What two lists must share before one may reuse the other's parse:
+    each quantity with the words on either side of it, in order, plus the set of all other words.
+    Keeps "חלב 2, לחם 3" apart from "חלב 3, לחם 2", "3 ליטר" from "3 בקבוקים" and "בלי סוכר" from "עם סוכר"
+    """
+    tokens = SIGNATURE_TOKEN_RE.findall(text)
+    quantities = tuple(
+        (tokens[i - 1] if i > 0 else None, token, tokens[i + 1] if i + 1 < len(tokens) else None)
+        for i, token in enumerate(tokens)
+        if QUANTITY_TOKEN_RE.fullmatch(token)
+    )
+    words = frozenset(token for token in tokens if not QUANTITY_TOKEN_RE.fullmatch(token))
+    return quantities, words
+
+
+async def embed_shopping_list(client, items_text):
+    """
+    Return the normalized embedding of a shopping list, or None if the call fails
     """
     try:
-        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        response = await client.chat.completions.create(
-            model="gpt-4",
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=items_text)
+    except Exception as e:
+        logger.warning("Embedding failed, skipping semantic cache: %s", e)
+        return None
+
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+def fast_parse_shopping_list(items_text: str) -> Optional[List[ShoppingItem]]:
+    """
+    Parse simple shopping lists locally; return None when the LLM is needed
+    """
+    items = []
+    for line in ITEM_SEPARATOR_RE.split(items_text):
+        line = line.strip()
+        if not line:
+            continue
+
+        match = ITEM_LINE_RE.fullmatch(line)
+        if not match:
+            return None
+
+        # Without a quantity there's no sign the line is a single item ("חלב ולחם"), and long
+        # names are usually sentences or several items; both go to the LLM
+        if not (match.group("qty") or match.group("qty_word")):
+            return None
+        words = match.group("name").split()
+        if len(words) > FAST_PARSE_MAX_NAME_WORDS:
+            return None
+        # A later word with the ו- prefix ("חלב אורגני ולחם") usually starts a second item;
+        # splitting it safely needs the LLM
+        if any(word.startswith("ו") for word in words[1:]):
+            return None
+        unit_word = match.group("unit")
+        # A unit word inside the name ("מלפפון קילו וחצי") means the quantity wasn't understood
+        if any(word in UNIT_WORDS for word in words) or (unit_word and unit_word not in UNIT_WORDS):
+            return None
+
+        if match.group("qty_word"):
+            quantity = HEBREW_QUANTITIES[match.group("qty_word")]
+        else:
+            quantity = float(match.group("qty") or 1)
+
+        brand = next((word for word in words[1:] if word in KNOWN_BRANDS), None)
+        if brand:
+            words.remove(brand)
+
+        items.append(ShoppingItem(
+            product_name=" ".join(words),
+            brand=brand,
+            quantity=quantity,
+            unit=UNIT_WORDS.get(unit_word, "pieces")
+        ))
+
+    return items or None
+
+async def parse_shopping_list(items_text: str, on_item: Optional[Callable[[ShoppingItem], None]] = None) -> List[ShoppingItem]:
+    """
+    Use OpenAI to parse shopping list text into structured items.
+    on_item is called with each item as soon as the model finishes generating it
+    """
+    items = fast_parse_shopping_list(items_text)
+    if items is not None:
+        return items
+
+    cache_key = items_text.strip()
+    if cache_key in _parse_cache:
+        return list(_parse_cache[cache_key])
+
+    try:
+        # Shared client: its connection pool is reused across requests
+        client = get_openai_client()
+
+        signature = shopping_list_signature(cache_key)
+        embedding = await embed_shopping_list(client, cache_key)
+        if embedding is not None:
+            items = semantic_parse_cache.lookup(embedding, signature)
+            if items is not None:
+                return list(items)
+
+        stream = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            response_format={"type": "json_object"},
             messages=[
+                # Static system prompt first: OpenAI only caches an identical prefix of 1024+ tokens
                 {"role": "system", "content": SHOPPING_PARSER_PROMPT},
                 {"role": "user", "content": items_text}
             ],
-            temperature=0.1
+            temperature=0.1,
+            stream=True
         )
+
+        # Hand out items while later ones are still generating
+        streaming_parser = StreamingArrayParser()
+        content = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            content.append(delta)
+            if on_item is not None:
+                for raw_item in streaming_parser.feed(delta):
+                    on_item(ShoppingItem.model_validate_json(raw_item))
         
-        parsed_json = json.loads(response.choices[0].message.content)
-        return [ShoppingItem(**item) for item in parsed_json]
+        # Decode and validate the full JSON object in one pydantic-core pass
+        items = ShoppingResponse.model_validate_json("".join(content)).items
+
+        if len(_parse_cache) >= PARSE_CACHE_MAX_SIZE:
+            # Dicts keep insertion order, so the first key is the oldest
+            _parse_cache.pop(next(iter(_parse_cache)))
+        _parse_cache[cache_key] = items
+        if embedding is not None:
+            semantic_parse_cache.add(embedding, signature, items)
+        return list(items)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to parse shopping list: {str(e)}")
 
 
-# async def shop_with_parsed_items(username, password, items: List[ShoppingItem]):
-#     """
-#     Execute shopping automation with parsed items using the service
-#     """
-#     async with async_playwright() as p:
-#         browser = await p.chromium.launch(headless=False)
-#         page = await browser.new_page()
-#
-#         try:
-#             # Login using the service
-#             await login_to_shufersal(page, username, password)
-#             print("✅ Login successful")
-#
-#             # Process each item
-#             for item in items:
-#                 print(f"Processing: {item.quantity} {item.unit} {item.product_name}")
-#
-#                 # Search for product using the service
-#                 search_term = f"{item.brand} {item.product_name}" if item.brand else item.product_name
-#                 await search_product(page, search_term)
-#                 print(f"✅ Searched for {search_term}")
-#
-#                 # Add to cart with quantity
-#                 try:
-#                     # Set quantity first
-#                     await page.fill("input.js-qty-selector-input", str(item.quantity))
-#
-#                     # Click add button
-#                     try:
-#                         await page.click('button:has-text("הוספה")', timeout=5000)
-#                     except:
-#                         await page.click('.js-add-to-cart', timeout=5000)
-#
-#                     await page.wait_for_timeout(2000)
-#                     print(f"✅ Added {item.quantity} {item.unit} to cart")
-#                 except Exception as e:
-#                     print(f"⚠️ Could not add to cart: {str(e)}")
-#
-#             await browser.close()
-#             return {
-#                 "success": True,
-#                 "message": f"Successfully processed {len(items)} items"
-#             }
-#
-#         except Exception as e:
-#             await browser.close()
-#             return {
-#                 "success": False,
-#                 "message": f"Error: {str(e)}"
-#             }
-
 @app.post("/shop")
 async def shop_endpoint(request: ShopRequest):
     """
     Parse shopping list and execute Shufersal automation
     """
-    # Parse the shopping list
-    # items = await parse_shopping_list(request.items_text)
+    # Parse the shopping list, warming the search cache for each item as the model emits it
+    prefetches = []
+    try:
+        items = await parse_shopping_list(
+            request.items_text,
+            on_item=lambda item: prefetches.append(asyncio.create_task(prefetch_search(build_search_term(item))))
+        )
+    except BaseException:
+        # The parse failed mid-stream: stop and reap the searches it already started
+        for prefetch in prefetches:
+            prefetch.cancel()
+        await asyncio.gather(*prefetches, return_exceptions=True)
+        raise
     
-    # Execute the complete shopping flow using the service
-    result = await shopping_flow(request.username, request.password, None)
+    if not items:
+        await asyncio.gather(*prefetches, return_exceptions=True)
+        return {
+            "parsed_items": [],
+            "success": False,
+            "message": "No shopping items found in the list"
+        }
+
+    # Execute the complete shopping flow using the service: all items are
+    # searched in parallel tabs, then the best matches are added to the cart.
+    # Each request gets its own context on the shared browser
+    try:
+        result = await shopping_flow(request.username, request.password, items, browser=await get_shared_browser())
+    finally:
+        # Never leave prefetches running unawaited, whichever way the flow ends
+        await asyncio.gather(*prefetches, return_exceptions=True)
     
     return {
-        # "parsed_items": [item.model_dump() for item in items],
+        "parsed_items": [item.model_dump() for item in items],
         "success": result["success"],
         "message": result["message"]
     }
@@ -172,4 +418,4 @@ async def root():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8002)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8002, loop="uvloop", http="httptools")
\ No newline at end of file
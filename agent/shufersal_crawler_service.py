@@ -1,19 +1,118 @@
 import asyncio
-import json
+from collections import Counter
+import hashlib
+import hmac
+import logging
+from functools import lru_cache
+import httpx
 import openai
+import orjson
 import os
-from crawl4ai import AsyncWebCrawler
-from playwright.async_api import async_playwright
+import time
+from urllib.parse import quote
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
+from selectolax.parser import HTMLParser
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+SHUFERSAL_LOGIN_URL = "https://www.shufersal.co.il/online/he/login"
+SHUFERSAL_ACCOUNT_URL = "https://www.shufersal.co.il/online/he/my-account"
+SHUFERSAL_SEARCH_URL = "https://www.shufersal.co.il/online/he/search"
+
+# Headers for the plain-HTTP search path, so the site serves the regular results page
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept-Language": "he-IL,he;q=0.9"
+}
+
+PRODUCT_TILE_SELECTOR = "li.SEARCH.tileBlock"
+QTY_INPUT_SELECTOR = "input.js-qty-selector-input"
+PRODUCT_TILE_BY_CODE_SELECTOR = 'li[data-product-code="{product_code}"]'
+ADD_TO_CART_BUTTON_SELECTOR = "button.js-add-to-cart"
+
+# Maximum number of search tabs open at the same time
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", "5"))
+# Maximum number of add-to-cart tabs open at the same time
+CART_CONCURRENCY = int(os.getenv("CART_CONCURRENCY", "3"))
+
+# Candidates per item sent to the matching LLM, after local ranking
+MAX_LLM_CANDIDATES = int(os.getenv("MAX_LLM_CANDIDATES", "10"))
+# Candidate fields the matching prompt uses, mapped to the short keys sent to the LLM; unit_price duplicates price
+LLM_CANDIDATE_FIELDS = {
+    "name": "n",
+    "brand": "b",
+    "price": "p",
+    "unit": "u",
+    "unit_size": "s",
+    "promotion": "pr",
+    "product_code": "id"
+}
+
+# Run Chromium without a window unless SHUFERSAL_HEADLESS=false (useful for debugging)
+HEADLESS = os.getenv("SHUFERSAL_HEADLESS", "true").lower() != "false"
+BROWSER_ARGS = ["--disable-dev-shm-usage", "--disable-gpu", "--disable-extensions"]
+# Resource types the crawler never reads; stylesheets are kept because innerText and
+# click actionability depend on the page layout
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font"}
+
+# Saved login sessions (cookies/localStorage), one file per user, readable by the owner only
+STORAGE_STATE_DIR = os.path.expanduser(os.getenv("SHUFERSAL_STATE_DIR", "~/.shufersal_sessions"))
+STORAGE_STATE_MAX_AGE = 24 * 60 * 60
+# A saved session is only reused by callers presenting the password that created it
+PASSWORD_HASH_ITERATIONS = 200_000
+# Per-user locks so concurrent flows don't log in (and overwrite the session file) at once
+_login_locks = {}
+
+# Search results cache: normalized search term -> (stored_at, candidates)
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "600"))
+SEARCH_CACHE_MAX_SIZE = 512
+_search_cache = {}
+# Futures for searches currently running, so concurrent duplicates wait instead of re-crawling
+_inflight_searches = {}
+# Shared across requests so prefetches from concurrent /shop calls stay within SEARCH_CONCURRENCY
+_prefetch_semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+
+
+def _search_cache_key(product_name):
+    return " ".join(product_name.split()).casefold()
+
+
+def get_cached_search(product_name):
+    """
+    Return cached candidates for a search term, or None if missing or expired
+    """
+    key = _search_cache_key(product_name)
+    entry = _search_cache.get(key)
+    if entry is None:
+        return None
+
+    stored_at, candidates = entry
+    if time.monotonic() - stored_at > SEARCH_CACHE_TTL:
+        del _search_cache[key]
+        return None
+    return candidates
+
+
+def cache_search_results(product_name, candidates):
+    """
+    Store candidates for a search term, evicting the oldest entry when full
+    """
+    key = _search_cache_key(product_name)
+    _search_cache.pop(key, None)
+    if len(_search_cache) >= SEARCH_CACHE_MAX_SIZE:
+        # Dicts keep insertion order, so the first key is the oldest
+        _search_cache.pop(next(iter(_search_cache)))
+    _search_cache[key] = (time.monotonic(), candidates)
+
 
 async def login_to_shufersal(page, username, password):
     """
     Login to Shufersal website
     """
-    await page.goto("https://www.shufersal.co.il/online/he/login")
+    await page.goto(SHUFERSAL_LOGIN_URL)
     await page.wait_for_selector("#j_username", timeout=10000)
 
     await page.fill("#j_username", username)
@@ -38,237 +137,448 @@ async def login_to_shufersal(page, username, password):
         else:
             await page.keyboard.press("Enter")
 
-    await page.wait_for_timeout(3000)
-
-    if "/login" in page.url:
+    # Wait for the redirect away from the login page instead of a fixed sleep
+    try:
+        await page.wait_for_url(lambda url: "/login" not in url, timeout=10000)
+    except PlaywrightTimeoutError:
         raise Exception("Login failed")
 
     return True
 
 
-async def extract_product_details(product_element):
+async def block_heavy_resources(route):
     """
-    Extract detailed information from a product element
+    Abort requests for resources the crawler doesn't need
     """
-    try:
-        # Basic product info
-        product_code = await product_element.get_attribute("data-product-code")
-        price = await product_element.get_attribute("data-product-price")
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
 
-        # Extract full product name from description
-        name = ""
-        try:
-            name_element = await product_element.query_selector(".text.description strong")
-            if name_element:
-                name = await name_element.inner_text()
-        except:
-            pass
-
-        # Extract unit_size and brand from labelsListContainer
-        unit_size = None
-        brand = None
-        try:
-            spans = await product_element.query_selector_all(".labelsListContainer .smallText span")
-            if len(spans) >= 1:
-                unit_size = await spans[0].inner_text()
-            if len(spans) > 1:
-                brand = await spans[-1].inner_text()
-        except:
-            pass
-
-        # Extract unit information
-        unit = "יח'"
-        unit_price = float(price) if price else 0
-        try:
-            unit_element = await product_element.query_selector(".unitPick span[aria-hidden='true']")
-            if unit_element:
-                unit = await unit_element.inner_text()
-        except:
-            pass
-
-        # Extract promotion details (simple text only)
-        promotion = None
-        try:
-            promotion_element = await product_element.query_selector(
-                ".promotion-section .productInnerPromotion .subText strong")
-            if promotion_element:
-                promotion = await promotion_element.inner_text()
-        except:
-            pass
 
-        return {
-            "name": name or "",
-            "brand": brand,
-            "price": float(price) if price else 0,
-            "unit": unit,
-            "unit_size": unit_size,
-            "unit_price": unit_price,
-            "product_code": product_code or "",
-            "promotion": promotion
-        }
-    except Exception as e:
-        print(f"Error extracting product details: {str(e)}")
-        return None
+def storage_state_path(username):
+    """
+    Path of the saved login session for a user
+    """
+    user_hash = hashlib.sha256(username.strip().lower().encode()).hexdigest()[:16]
+    return os.path.join(STORAGE_STATE_DIR, f"shufersal_state_{user_hash}.json")
 
 
-async def extract_search_results(page):
+def saved_storage_state(username):
     """
-    Extract all product details from search results page
+    Return the saved session path for a user if it exists and is fresh enough to reuse
     """
-    products = []
+    path = storage_state_path(username)
     try:
-        # Wait for search results to load
-        await page.wait_for_selector("li.SEARCH.tileBlock", timeout=5000)
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+    return path if age < STORAGE_STATE_MAX_AGE else None
 
-        # Get all product elements
-        product_elements = await page.query_selector_all("li.SEARCH.tileBlock")
-        print(f"Found {len(product_elements)} products")
 
-        for i, element in enumerate(product_elements):
-            print(f"Extracting product {i + 1}...")
-            product_details = await extract_product_details(element)
-            if product_details:
-                products.append(product_details)
+def password_verifier_path(username):
+    """
+    Path of the salted password hash stored next to a user's saved session
+    """
+    return storage_state_path(username)[:-len(".json")] + ".key"
 
-        return products
-    except Exception as e:
-        print(f"Error extracting search results: {str(e)}")
-        return []
 
+def write_private_file(path, data):
+    """
+    Write bytes to a file only the current user can read, in a directory only they can list
+    """
+    os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        # The mode above only applies to new files; tighten ones left by older versions too
+        os.fchmod(f.fileno(), 0o600)
+        f.write(data)
 
-async def search_product(page, product_name):
+
+def save_storage_state(username, state):
     """
-    Search for a product and extract all results
+    Persist a context's storage state (session cookies) for a user
     """
-    search_input = await page.wait_for_selector("#js-site-search-input", timeout=10000)
-    await search_input.fill(product_name)
-    await page.keyboard.press("Enter")
-    await page.wait_for_timeout(3000)
+    write_private_file(storage_state_path(username), orjson.dumps(state))
 
-    # Extract and print all products from search results
-    products = await extract_search_results(page)
-    print(f"\n=== Search Results for '{product_name}' ===")
-    print(json.dumps(products, ensure_ascii=False, indent=2))
 
-    return products
+def save_password_verifier(username, password):
+    """
+    Record a salted hash of the password that created the saved session
+    """
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PASSWORD_HASH_ITERATIONS)
+    write_private_file(password_verifier_path(username), f"{salt.hex()}:{digest.hex()}".encode())
 
 
-async def search_single_product_in_tab(browser, product_name):
+def password_matches_saved_session(username, password):
     """
-    Search for a single product in a new tab and return candidates (no login needed)
+    Check the password against the one that created the saved session; False when unknown
     """
-    page = await browser.new_page()
     try:
-        # Navigate to main page (no login needed for search)
-        await page.goto("https://www.shufersal.co.il/online/he")
-        await page.wait_for_timeout(1000)
-
-        # Search for the product
-        print(f"Searching for '{product_name}'...")
-        search_input = await page.wait_for_selector("#js-site-search-input", timeout=10000)
-        await search_input.fill(product_name)
-        await page.keyboard.press("Enter")
-        await page.wait_for_timeout(3000)
-
-        # Extract candidates
-        candidates = await extract_search_results(page)
-        print(f"Found {len(candidates)} candidates for '{product_name}'")
+        with open(password_verifier_path(username)) as f:
+            salt_hex, digest_hex = f.read().strip().split(":")
+        salt, expected = bytes.fromhex(salt_hex), bytes.fromhex(digest_hex)
+    except (OSError, ValueError):
+        return False
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PASSWORD_HASH_ITERATIONS)
+    return hmac.compare_digest(digest, expected)
+
+
+def login_lock(username):
+    """
+    Lock serializing logins (and session file writes) for one user across concurrent flows
+    """
+    return _login_locks.setdefault(storage_state_path(username), asyncio.Lock())
+
+
+def read_storage_state(path):
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
 
+async def session_is_valid(page):
+    """
+    Check whether the context's cookies hold a live session
+    """
+    await page.goto(SHUFERSAL_ACCOUNT_URL)
+    return "/login" not in page.url
+
+
+async def ensure_logged_in(context, username, password, restored=False):
+    """
+    Reuse the session restored into the context, logging in only when it is missing or expired
+    """
+    started_at = time.time()
+    page = await context.new_page()
+    try:
+        if restored and await session_is_valid(page):
+            logger.info("✅ Reusing saved login session")
+            return True
+
+        async with login_lock(username):
+            # Another flow may have refreshed the session while this one waited for the lock;
+            # its cookies are only borrowed by a caller with the same password
+            state_path = saved_storage_state(username)
+            if (
+                state_path is not None
+                and os.path.getmtime(state_path) > started_at
+                and await asyncio.to_thread(password_matches_saved_session, username, password)
+            ):
+                state = await asyncio.to_thread(read_storage_state, state_path)
+                await context.add_cookies(state["cookies"])
+                if await session_is_valid(page):
+                    logger.info("✅ Reusing login session refreshed by another request")
+                    return True
+
+            await login_to_shufersal(page, username, password)
+            logger.info("✅ Login successful")
+            # Written by us rather than Playwright so the cookie jar is never world-readable
+            await asyncio.to_thread(save_storage_state, username, await context.storage_state())
+            await asyncio.to_thread(save_password_verifier, username, password)
+            return True
+    finally:
         await page.close()
-        return {
-            "user_item": product_name,
-            "candidates": candidates
-        }
 
+
+def parse_price(value):
+    """
+    Convert a data-product-price attribute to float, 0 when missing or malformed
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def node_text(node):
+    """
+    Visible text of a node, with inline children kept apart by single spaces
+    ("2 <span>יח'</span> ב- 30" -> "2 יח' ב- 30")
+    """
+    return " ".join(node.text(separator=" ").split())
+
+
+def parse_search_results_html(html):
+    """
+    Extract product tiles from a search results page's HTML
+    """
+    products = []
+    for tile in HTMLParser(html).css(PRODUCT_TILE_SELECTOR):
+        name = tile.css_first(".text.description strong")
+        labels = tile.css(".labelsListContainer .smallText span")
+        unit = tile.css_first('.unitPick span[aria-hidden="true"]')
+        promotion = tile.css_first(".promotion-section .productInnerPromotion .subText strong")
+        product_code = tile.attributes.get("data-product-code") or ""
+        name_text = node_text(name) if name else ""
+        # Skip placeholder/ad tiles that can't be matched or added to the cart
+        if not product_code and not name_text:
+            continue
+        price = parse_price(tile.attributes.get("data-product-price"))
+
+        products.append({
+            "name": name_text,
+            "brand": node_text(labels[-1]) if len(labels) > 1 else None,
+            "price": price,
+            "unit": node_text(unit) if unit else "יח'",
+            "unit_size": node_text(labels[0]) if labels else None,
+            "unit_price": price,
+            "product_code": product_code,
+            "promotion": node_text(promotion) if promotion else None
+        })
+    return products
+
+
+async def extract_search_results(page):
+    """
+    Extract all product details from search results page
+    """
+    try:
+        # Wait for search results to load (this is the only wait after submitting a search)
+        await page.wait_for_selector(PRODUCT_TILE_SELECTOR, timeout=10000)
+
+        # Pull the rendered HTML once and parse it in-process, no per-tile round-trips
+        # Callers log the count, once per search
+        return parse_search_results_html(await page.content())
     except Exception as e:
-        print(f"Error searching for '{product_name}': {str(e)}")
-        await page.close()
-        return {
-            "user_item": product_name,
-            "candidates": []
-        }
+        logger.warning("Error extracting search results: %s", e)
+        return []
 
 
-async def search_in_tab(context, product_name):
+async def http_search(http_client, product_name):
     """
-    Search for a single product in a new tab using browser context
+    Fetch search results without a browser; returns None when the browser path is needed
     """
+    try:
+        response = await http_client.get(SHUFERSAL_SEARCH_URL, params={"text": product_name})
+    except httpx.HTTPError as e:
+        logger.warning("HTTP search failed for '%s': %s", product_name, e)
+        return None
+
+    if response.status_code != 200:
+        return None
+    return parse_search_results_html(response.text) or None
+
+
+def search_url(product_name):
+    """
+    URL of the search results page for a term
+    """
+    return f"{SHUFERSAL_SEARCH_URL}?text={quote(product_name)}"
+
+
+async def search_single_product_in_tab(browser, product_name):
+    """
+    Search for a single product in a new tab and return candidates (no login needed).
+    Goes through search_in_tab so repeated terms are served from the search cache
+    """
+    # Browser.new_page() mirrors BrowserContext.new_page(), so the browser can stand in for a context
+    return await search_in_tab(browser, product_name)
+
+
+async def fetch_search_candidates(context, product_name, http_client=None):
+    """
+    Crawl candidates for a search term, over HTTP when possible and in a new tab otherwise
+    """
+    if http_client is not None:
+        candidates = await http_search(http_client, product_name)
+        if candidates:
+            logger.info("Found %d candidates for '%s' over HTTP", len(candidates), product_name)
+            cache_search_results(product_name, candidates)
+            return candidates
+
     page = await context.new_page()
     try:
-        # Navigate to main page
-        await page.goto("https://www.shufersal.co.il/online/he")
-        await page.wait_for_timeout(1000)
-
-        # Search for the product
-        print(f"Searching for '{product_name}'...")
-        search_input = await page.wait_for_selector("#js-site-search-input", timeout=10000)
-        await search_input.fill(product_name)
-        await page.keyboard.press("Enter")
-        await page.wait_for_timeout(3000)
-
-        # Extract candidates
-        candidates = await extract_search_results(page)
-        print(f"Found {len(candidates)} candidates for '{product_name}'")
+        # Open the results page directly instead of typing into the home page search box
+        logger.debug("Searching for '%s'...", product_name)
+        await page.goto(search_url(product_name), wait_until="domcontentloaded")
 
-        await page.close()
-        return {
-            "user_item": product_name,
-            "candidates": candidates
-        }
+        # Extract candidates (waits for the result tiles)
+        candidates = await extract_search_results(page)
+        logger.info("Found %d candidates for '%s'", len(candidates), product_name)
+        if candidates:
+            cache_search_results(product_name, candidates)
+        return candidates
 
     except Exception as e:
-        print(f"Error searching for '{product_name}': {str(e)}")
+        logger.warning("Error searching for '%s': %s", product_name, e)
+        return []
+    finally:
         await page.close()
+
+
+async def search_in_tab(context, product_name, http_client=None):
+    """
+    Search for a single product using browser context.
+    Tries a plain HTTP fetch first when an http_client is given
+    """
+    cached = get_cached_search(product_name)
+    if cached is not None:
+        logger.debug("Using cached results for '%s'", product_name)
         return {
             "user_item": product_name,
-            "candidates": []
+            "candidates": cached
         }
 
+    key = _search_cache_key(product_name)
+    pending = _inflight_searches.get(key)
+    if pending is not None:
+        logger.debug("Waiting for in-flight search of '%s'", product_name)
+        # shield: a cancelled waiter must not cancel the search other callers share
+        candidates = await asyncio.shield(pending)
+        if candidates:
+            return {
+                "user_item": product_name,
+                "candidates": candidates
+            }
+
+    candidates = await track_inflight_search(key, fetch_search_candidates(context, product_name, http_client))
+    return {
+        "user_item": product_name,
+        "candidates": candidates
+    }
 
-async def parallel_search_with_tabs(search_terms):
+
+async def track_inflight_search(key, search):
+    """
+    Await a search coroutine while publishing its result to concurrent callers of the same term
+    """
+    future = asyncio.get_running_loop().create_future()
+    _inflight_searches[key] = future
+    try:
+        candidates = await search
+        future.set_result(candidates)
+        return candidates
+    finally:
+        if not future.done():
+            future.set_result([])
+        if _inflight_searches.get(key) is future:
+            del _inflight_searches[key]
+
+
+@lru_cache(maxsize=1)
+def get_http_client():
     """
-    Run parallel searches for multiple products using ONE browser context with multiple tabs
+    Return the shared HTTP/2 client for plain-HTTP searches, created on first use
     """
-    print(f"Running parallel searches for: {search_terms}")
+    return httpx.AsyncClient(
+        http2=True,
+        headers=HTTP_HEADERS,
+        timeout=10.0,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=16, keepalive_expiry=60)
+    )
 
-    async with async_playwright() as p:
-        # Create ONE browser instance with context
-        browser = await p.chromium.launch(headless=False)
-        context = await browser.new_context()
 
-        try:
-            # Create tasks for parallel execution using tabs from the SAME context
-            tasks = [search_in_tab(context, term) for term in search_terms]
+async def prefetch_search(product_name):
+    """
+    Warm the search cache for a term over HTTP, e.g. while the rest of the list is still being parsed
+    """
+    key = _search_cache_key(product_name)
+    if get_cached_search(product_name) is not None or key in _inflight_searches:
+        return
 
-            # Run all searches in parallel
-            results = await asyncio.gather(*tasks, return_exceptions=True)
+    async def fetch():
+        # Registered as in-flight before queueing, so the flow's own search waits instead of duplicating it
+        async with _prefetch_semaphore:
+            candidates = await http_search(get_http_client(), product_name)
+        if candidates:
+            cache_search_results(product_name, candidates)
+        return candidates or []
 
-            # Filter out any exceptions
-            candidate_lists = []
-            for result in results:
-                if isinstance(result, dict):
-                    candidate_lists.append(result)
-                else:
-                    print(f"Search error: {result}")
+    await track_inflight_search(key, fetch())
 
-            await browser.close()
-            return candidate_lists
 
-        except Exception as e:
-            print(f"Error in parallel search: {str(e)}")
-            await browser.close()
-            return []
+async def new_shufersal_context(browser, storage_state=None):
+    """
+    Create a browser context for Shufersal with heavy resources blocked
+    """
+    context = await browser.new_context(
+        storage_state=storage_state,
+        viewport={"width": 1280, "height": 800},
+        extra_http_headers={"Accept-Language": HTTP_HEADERS["Accept-Language"]}
+    )
+    await context.route("**/*", block_heavy_resources)
+    return context
 
 
-async def find_best_matches_with_llm(candidate_lists):
+async def parallel_search_with_tabs(search_terms, context=None):
     """
-    Use LLM to find the best product matches from candidate lists
+    Run parallel searches for multiple products using ONE browser context with multiple tabs.
+    Uses the given context, or launches a browser of its own when none is passed
     """
+    if context is None:
+        async with async_playwright() as p:
+            browser = await p.chromium.launch(headless=HEADLESS, args=BROWSER_ARGS)
+            try:
+                context = await new_shufersal_context(browser)
+                return await parallel_search_with_tabs(search_terms, context)
+            finally:
+                await browser.close()
+
+    logger.info("Running parallel searches for: %s", search_terms)
+
     try:
-        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
-        # Create the prompt
-        prompt = """You are an expert shopping assistant for an Israeli supermarket (Shufersal). Your task is to find the best product matches from search results.
+        # Bound the number of open tabs so long lists don't thrash the browser or the site
+        semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+
+        # Shared HTTP/2 client for the plain-HTTP fast path: its connections stay warm across calls
+        http_client = get_http_client()
+
+        async def bounded_search(term):
+            async with semaphore:
+                return await search_in_tab(context, term, http_client)
+
+        # Search each distinct term once; duplicates (up to spacing/case) share the result
+        unique_terms = {}
+        for term in search_terms:
+            unique_terms.setdefault(_search_cache_key(term), term)
+
+        # Create tasks for parallel execution using tabs from the SAME context
+        tasks = [bounded_search(term) for term in unique_terms.values()]
+
+        # Run all searches in parallel
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        results_by_key = {}
+        for key, result in zip(unique_terms, results):
+            if isinstance(result, dict):
+                results_by_key[key] = result["candidates"]
+            else:
+                logger.warning("Search error: %s", result)
+
+        # Map back to the original terms and order, skipping failed searches
+        candidate_lists = []
+        for term in search_terms:
+            candidates = results_by_key.get(_search_cache_key(term))
+            if candidates is not None:
+                candidate_lists.append({
+                    "user_item": term,
+                    "candidates": candidates
+                })
+
+        return candidate_lists
+
+    except Exception as e:
+        logger.error("Error in parallel search: %s", e)
+        return []
+
+
+@lru_cache(maxsize=1)
+def get_openai_client():
+    """
+    Return the shared AsyncOpenAI client, created on first use
+    """
+    # The SDK retries connection errors, 429 and 5xx with exponential backoff;
+    # the timeout bounds the total time spent on a single attempt
+    return openai.AsyncOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        max_retries=3,
+        timeout=60.0
+    )
+
+
+BEST_MATCH_PROMPT = """You are an expert shopping assistant for an Israeli supermarket (Shufersal). Your task is to find the best product matches from search results.
 
 MATCHING RULES:
 1. **Name Match**: Find the most exact name match first
@@ -285,19 +595,24 @@ in account the unit and understand that the item is not packed and this is item
 7. Consider take small products if user asked, for example שקית קטנה ביסלי if you have match for 2 items but the user asked for the smallest look at unit_size of the product.
 
 INPUT FORMAT:
-For each user item, you'll receive candidates with: name, brand, price, unit_size, promotion, product_code
+Keys are shortened to save space. Each user item is {"q": search term, "r": requested, "c": candidates}.
+Each candidate has: "n" name, "b" brand, "p" price, "u" unit, "s" unit_size, "pr" promotion, "id" product_code. Missing keys have no value.
+When "r" is set, it holds the quantity, unit and preferences the user asked for (e.g. "0.5 kg", "3 pieces, טעם בצל") - use it to pick the product and quantity.
+In the output, user_item is the item's "q", product_name is the candidate's "n" and product_code is its "id".
 
 OUTPUT FORMAT:
-Return ONLY a JSON array with this exact structure:
-[
-  {
-    "user_item": "original search term",
-    "product_name": "exact product name from candidates",
-    "product_code": "exact product code",
-    "quantity": number (can be decimal like 0.5, 1.5, 2.5 - consider promotions!),
-    "reason": "brief explanation of choice and quantity reasoning"
-  }
-]
+Return ONLY a JSON object with this exact structure:
+{
+  "matches": [
+    {
+      "user_item": "original search term",
+      "product_name": "exact product name from candidates",
+      "product_code": "exact product code",
+      "quantity": number (can be decimal like 0.5, 1.5, 2.5 - consider promotions!),
+      "reason": "brief explanation of choice and quantity reasoning"
+    }
+  ]
+}
 
 EXAMPLES:
 - User searches "מלפפון חצי קילו" → Choose cucumber, quantity: 0.5 (half kilo). Convert it to correct number.
@@ -307,30 +622,148 @@ EXAMPLES:
 
 BE SMART WITH PROMOTIONS - always calculate if the promotion quantity gives better value!
 
-Here are the candidates:
+The candidates are provided in the user message.
 """
 
-        prompt += json.dumps(candidate_lists, ensure_ascii=False, indent=2)
+
+def char_trigrams(text):
+    """
+    Set of character trigrams of the padded words in a text, robust to Hebrew prefixes and plurals
+    """
+    grams = set()
+    for word in text.split():
+        padded = f" {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def score_candidate(search_term, candidate, term_grams=None):
+    """
+    Score a candidate by exact word hits, then by trigram overlap with its name and brand
+    """
+    text = f"{candidate.get('name') or ''} {candidate.get('brand') or ''}"
+    word_hits = sum(1 for word in set(search_term.split()) if word in text)
+
+    term_grams = term_grams if term_grams is not None else char_trigrams(search_term)
+    text_grams = char_trigrams(text)
+    if not term_grams or not text_grams:
+        return word_hits, 0.0
+    # Cosine similarity of the binary trigram vectors
+    overlap = len(term_grams & text_grams) / (len(term_grams) * len(text_grams)) ** 0.5
+    return word_hits, overlap
+
+
+def rank_candidates(search_term, candidates):
+    """
+    Sort candidates by local match score, keeping the site's order for ties
+    """
+    term_grams = char_trigrams(search_term)
+    return sorted(candidates, key=lambda c: score_candidate(search_term, c, term_grams), reverse=True)
+
+
+class StreamingArrayParser:
+    """
+    Pick complete objects out of a streamed {"<key>": [...]} JSON response as they close
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.entry_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        completed = []
+        for index in range(self.position, len(self.text)):
+            char = self.text[index]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                # Entries are the objects directly inside the top-level object's array
+                if char == "{" and self.depth == 2:
+                    self.entry_start = index
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if char == "}" and self.depth == 2 and self.entry_start is not None:
+                    completed.append(self.text[self.entry_start:index + 1])
+                    self.entry_start = None
+        self.position = len(self.text)
+        return completed
+
+
+async def find_best_matches_with_llm(candidate_lists, on_match=None):
+    """
+    Use LLM to find the best product matches from candidate lists.
+    on_match is called with each match as soon as the model finishes generating it
+    """
+    # Rank locally and only send the strongest candidates
+    candidate_lists = [
+        {
+            "user_item": item_data["user_item"],
+            "requested": item_data.get("requested"),
+            "candidates": rank_candidates(item_data["user_item"], item_data["candidates"])[:MAX_LLM_CANDIDATES]
+        }
+        for item_data in candidate_lists
+    ]
+    # Compact payload: only the fields the prompt uses, under short keys, nulls left out
+    payload = [
+        {
+            "q": item_data["user_item"],
+            "r": item_data["requested"],
+            "c": [
+                {key: candidate[field] for field, key in LLM_CANDIDATE_FIELDS.items() if candidate.get(field) is not None}
+                for candidate in item_data["candidates"]
+            ]
+        }
+        for item_data in candidate_lists
+    ]
+
+    try:
+        client = get_openai_client()
+
+        # Keep the system prompt static so OpenAI can cache it; only the candidates vary
+        # orjson emits compact UTF-8, so Hebrew isn't escaped and no indentation tokens are sent
+        candidates_json = orjson.dumps(payload).decode()
         
-        response = await client.chat.completions.create(
-            model="gpt-4",
+        stream = await client.chat.completions.create(
+            model="gpt-4o-mini",
+            response_format={"type": "json_object"},
             messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": "Find the best matches for each item, being smart about promotions and quantities."}
-            ]
+                {"role": "system", "content": BEST_MATCH_PROMPT},
+                {"role": "user", "content": "Find the best matches for each item, being smart about promotions and quantities.\n\nHere are the candidates:\n" + candidates_json}
+            ],
+            stream=True
         )
-        
-        # Parse the response
-        matches_json = response.choices[0].message.content.strip()
-        if matches_json.startswith("```json"):
-            matches_json = matches_json.replace("```json", "").replace("```", "").strip()
-        
-        best_matches = json.loads(matches_json)
-        return best_matches
+
+        # Hand out matches while later ones are still generating
+        streaming_parser = StreamingArrayParser()
+        content = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            content.append(delta)
+            if on_match is not None:
+                for raw_match in streaming_parser.feed(delta):
+                    on_match(orjson.loads(raw_match))
+
+        # JSON mode guarantees a single object, no code fences to strip
+        return orjson.loads("".join(content))["matches"]
         
     except Exception as e:
-        print(f"Error in LLM matching: {str(e)}")
-        # Fallback: return first candidate for each item
+        logger.warning("Error in LLM matching: %s", e)
+        # Fallback: return the top ranked candidate for each item
         fallback_matches = []
         for item_data in candidate_lists:
             if item_data['candidates']:
@@ -345,94 +778,107 @@ Here are the candidates:
         return fallback_matches
 
 
-async def add_to_cart_with_quantity(page, product_code, quantity):
+def is_cart_update(response):
     """
-    Set quantity and add product to cart
+    Match the POST the site sends when a product is added to the cart
     """
-    # Set quantity
-    await page.fill("input.js-qty-selector-input", str(quantity))
+    return "/cart" in response.url and response.request.method == "POST"
 
-    # Click add to cart button
-    try:
-        await page.click(f'li[data-product-code="{product_code}"] button.js-add-to-cart', timeout=5000)
-    except:
+
+# Runs in the page: clicks a tile's add-to-cart button directly, bypassing actionability checks
+CLICK_ADD_TO_CART_JS = """(selector) => {
+    const button = document.querySelector(selector);
+    if (!button) return false;
+    button.click();
+    return true;
+}"""
+
+
+async def add_to_cart_with_quantity(page, product_code, quantity, cart_lock):
+    """
+    Set quantity and add product to cart; cart_lock serializes cart updates within one cart
+    """
+    tile_selector = PRODUCT_TILE_BY_CODE_SELECTOR.format(product_code=product_code)
+    button_selector = f"{tile_selector} {ADD_TO_CART_BUTTON_SELECTOR}"
+
+    # Set quantity on this product's tile, not the first tile on the page
+    await page.fill(f"{tile_selector} {QTY_INPUT_SELECTOR}", str(quantity))
+
+    # Click add to cart button and wait for the cart update request to complete.
+    # Tabs navigate and search in parallel, but this cart's updates go one at a time
+    async with cart_lock, page.expect_response(is_cart_update, timeout=10000):
         try:
-            await page.click('button:has-text("הוספה")', timeout=5000)
-        except:
-            await page.click('.js-add-to-cart', timeout=5000)
+            await page.click(button_selector, timeout=2000)
+        except PlaywrightTimeoutError:
+            if not await page.evaluate(CLICK_ADD_TO_CART_JS, button_selector):
+                raise Exception(f"Add to cart button not found for product {product_code}")
 
-    await page.wait_for_timeout(2000)
     return True
 
-async def add_product_to_cart_in_tab(context, best_match):
+
+async def add_product_to_cart_in_tab(context, best_match, cart_lock):
     """
     Search for a specific product and add it to cart in a new tab
     """
+    # The LLM may omit keys; fall back to the user's term and a single unit
+    product_name = best_match.get("product_name") or best_match.get("user_item")
+    quantity = best_match.get("quantity") or 1
     page = await context.new_page()
     try:
-        # Navigate to main page
-        await page.goto("https://www.shufersal.co.il/online/he")
-        await page.wait_for_timeout(1000)
-        
-        # Search for the specific product
-        print(f"Searching for '{best_match['product_name']}'...")
-        search_input = await page.wait_for_selector("#js-site-search-input", timeout=10000)
-        await search_input.fill(best_match['product_name'])
-        await page.keyboard.press("Enter")
-        await page.wait_for_timeout(3000)
+        # Open the results page directly and wait for the product's tile instead of a fixed sleep
+        logger.debug("Searching for '%s'...", product_name)
+        await page.goto(search_url(product_name), wait_until="domcontentloaded")
+        await page.wait_for_selector(PRODUCT_TILE_BY_CODE_SELECTOR.format(product_code=best_match["product_code"]), timeout=10000)
         
         # Add to cart with quantity
-        print(f"Adding {best_match['quantity']} to cart...")
-        await page.fill("input.js-qty-selector-input", str(best_match['quantity']))
-        
-        # Click add to cart button for this specific product
-        try:
-            await page.click(f'li[data-product-code="{best_match["product_code"]}"] button.js-add-to-cart', timeout=5000)
-        except:
-            try:
-                await page.click('button:has-text("הוספה")', timeout=5000)
-            except:
-                await page.click('.js-add-to-cart', timeout=5000)
+        logger.debug("Adding %s to cart...", quantity)
+        await add_to_cart_with_quantity(page, best_match['product_code'], quantity, cart_lock)
         
-        await page.wait_for_timeout(2000)
-        print(f"✅ Added {best_match['product_name']} to cart")
+        logger.info("✅ Added %s to cart", product_name)
         
-        await page.close()
         return {
             "success": True,
-            "product": best_match['product_name'],
-            "quantity": best_match['quantity']
+            "product": product_name,
+            "quantity": quantity
         }
         
     except Exception as e:
-        print(f"Error adding {best_match['product_name']} to cart: {str(e)}")
-        await page.close()
+        logger.warning("Error adding %s to cart: %s", product_name, e)
         return {
             "success": False,
-            "product": best_match['product_name'],
+            "product": product_name,
             "error": str(e)
         }
+    finally:
+        await page.close()
 
-async def parallel_add_to_cart(context, best_matches):
+
+async def add_match_to_cart(context, match, semaphore, cart_lock):
     """
-    Add all best matches to cart in parallel using multiple tabs
+    Add one LLM match to the cart in its own tab, holding a slot of the tab semaphore
+    """
+    if not match.get("product_code"):
+        return {
+            "success": False,
+            "product": match.get("user_item"),
+            "error": match.get("reason") or "No match found"
+        }
+    async with semaphore:
+        logger.info("Adding %s (quantity: %s)...", match.get("product_name"), match.get("quantity"))
+        return await add_product_to_cart_in_tab(context, match, cart_lock)
+
+
+def summarize_cart_results(best_matches, results):
+    """
+    Count successful additions, logging each failure
     """
-    print(f"Adding {len(best_matches)} items to cart in parallel...")
-    
-    # Create tasks for parallel execution
-    tasks = [add_product_to_cart_in_tab(context, match) for match in best_matches]
-    
-    # Run all additions in parallel
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    # Process results
     success_count = 0
     for result in results:
         if isinstance(result, dict) and result.get("success"):
             success_count += 1
         else:
-            print(f"Failed to add item: {result}")
-    
+            logger.warning("Failed to add item: %s", result)
+
     return {
         "total_items": len(best_matches),
         "successful_additions": success_count,
@@ -440,59 +886,154 @@ async def parallel_add_to_cart(context, best_matches):
     }
 
 
+async def parallel_add_to_cart(context, best_matches):
+    """
+    Add all best matches to cart in parallel using multiple tabs
+    """
+    logger.info("Adding %d items to cart in parallel...", len(best_matches))
+
+    # Bound the number of open tabs, like the search fan-out; one lock per cart (context)
+    semaphore = asyncio.Semaphore(CART_CONCURRENCY)
+    cart_lock = asyncio.Lock()
+
+    tasks = [add_match_to_cart(context, match, semaphore, cart_lock) for match in best_matches]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    return summarize_cart_results(best_matches, results)
+
 
-async def shopping_flow(username, password, items=None):
+def build_search_term(item):
     """
-    Complete flow: search first, then login and add to cart
+    Build the Shufersal search term for a parsed shopping item
     """
-    try:
-        # Step 1: Parallel search using ONE browser with multiple tabs
-        search_terms = ["מלפפון חצי קילו", "ביסלי בצל"]
+    return f"{item.brand} {item.product_name}" if item.brand else item.product_name
 
-        print("Starting parallel searches with single browser...")
-        candidate_lists = await parallel_search_with_tabs(search_terms)
-        
-        # Step 1.5: Use LLM to find best matches from candidates
-        best_matches = await find_best_matches_with_llm(candidate_lists)
-        print(f"\n=== LLM Best Matches ===")
-        for match in best_matches:
-            print(f"User item: {match['user_item']}")
-            print(f"Best match: {match['product_name']} ({match['product_code']}) - Quantity: {match['quantity']}")
-            print(f"Reason: {match.get('reason', 'N/A')}")
-            print()
-
-        # Step 2: Login and add all best matches to cart in parallel
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=False)
-            context = await browser.new_context()
-            page = await context.new_page()
 
-            print("\nLogging in for cart operations...")
-            await login_to_shufersal(page, username, password)
-            print("✅ Login successful")
-            
-            # Close login page, context will maintain session
-            await page.close()
+def describe_requested(item):
+    """
+    Describe the requested quantity, unit and preferences of a parsed shopping item for the LLM
+    """
+    description = f"{item.quantity:g} {item.unit}"
+    if item.preferences:
+        description += f", {item.preferences}"
+    return description
 
-            print("\nAdding best matches to cart sequentially...")
-            cart_results = []
+
+async def run_shopping_flow(browser, username, password, items=None):
+    """
+    Search, match and add to cart in a fresh context on an already running browser
+    """
+    # The saved session (if any) is restored up front and shared by search and cart tabs,
+    # but only for a caller presenting the password that created it
+    state_path = saved_storage_state(username)
+    if state_path is not None and not await asyncio.to_thread(password_matches_saved_session, username, password):
+        state_path = None
+    context = await new_shufersal_context(browser, storage_state=state_path)
+
+    # Login (or session check) runs in its own tab while the searches and matching are in flight
+    login_task = asyncio.create_task(
+        ensure_logged_in(context, username, password, restored=state_path is not None)
+    )
+    try:
+        # Step 1: Parallel search using multiple tabs
+        # The demo terms are only for standalone runs without a list, never for an empty parse
+        if items is not None:
+            search_terms = [build_search_term(item) for item in items]
+        else:
+            search_terms = ["מלפפון חצי קילו", "ביסלי בצל"]
+            items = []
+
+        # Items sharing a search term ("חלב 2 ליטר, חלב 1 ליטר") each keep their own request
+        requested = {}
+        for term, item in zip(search_terms, items):
+            requested.setdefault(term, []).append(describe_requested(item))
+
+        logger.info("Starting parallel searches with single browser...")
+        candidate_lists = await parallel_search_with_tabs(search_terms, context)
+        for item_data in candidate_lists:
+            pending_requests = requested.get(item_data["user_item"])
+            if pending_requests:
+                item_data["requested"] = pending_requests.pop(0)
+
+        # Step 2 runs alongside matching: a worker waits for the login, then starts
+        # adding matches to the cart as the LLM streams them out
+        cart_queue = asyncio.Queue()
+        # Same bounds as parallel_add_to_cart: tab semaphore plus a lock for this user's cart
+        cart_semaphore = asyncio.Semaphore(CART_CONCURRENCY)
+        cart_lock = asyncio.Lock()
+        # Streamed matches per user item; duplicate items produce one match each
+        queued_items = Counter()
+
+        def queue_match(match):
+            queued_items[match.get("user_item")] += 1
+            cart_queue.put_nowait(match)
+
+        async def cart_worker():
+            await login_task
+            logger.info("Adding best matches to cart in parallel...")
+            additions = []
+            try:
+                while (match := await cart_queue.get()) is not None:
+                    additions.append(asyncio.create_task(add_match_to_cart(context, match, cart_semaphore, cart_lock)))
+                # One failed addition must not cancel the others once items are already in the cart
+                return await asyncio.gather(*additions, return_exceptions=True)
+            finally:
+                for addition in additions:
+                    addition.cancel()
+
+        cart_task = asyncio.create_task(cart_worker())
+        try:
+            # Step 1.5: Use LLM to find best matches from candidates
+            best_matches = await find_best_matches_with_llm(candidate_lists, on_match=queue_match)
             for match in best_matches:
-                print(f"Adding {match['product_name']} (quantity: {match['quantity']})...")
-                result = await add_product_to_cart_in_tab(context, match)
-                cart_results.append(result)
-            
-            # Count successes
-            success_count = sum(1 for r in cart_results if r.get("success"))
-            cart_summary = {
-                "total_items": len(best_matches),
-                "successful_additions": success_count,
-                "results": cart_results
-            }
-            
-            print(f"\n=== Cart Results ===")
-            print(f"Successfully added {success_count}/{len(best_matches)} items to cart")
+                logger.info(
+                    "Best match for '%s': %s (%s) - Quantity: %s. Reason: %s",
+                    match.get('user_item'), match.get('product_name'), match.get('product_code'), match.get('quantity'),
+                    match.get('reason', 'N/A')
+                )
+
+            # Matches that weren't streamed (e.g. the fallback path) are queued now
+            already_queued = Counter(queued_items)
+            for match in best_matches:
+                if already_queued[match.get("user_item")] > 0:
+                    already_queued[match.get("user_item")] -= 1
+                else:
+                    queue_match(match)
+            cart_queue.put_nowait(None)
 
-            await browser.close()
+            cart_results = await cart_task
+        finally:
+            if not cart_task.done():
+                cart_task.cancel()
+
+        cart_summary = summarize_cart_results(best_matches, cart_results)
+        logger.info("Successfully added %d/%d items to cart", cart_summary["successful_additions"], len(best_matches))
+    finally:
+        if not login_task.done():
+            login_task.cancel()
+        await context.close()
+
+
+async def shopping_flow(username, password, items=None, browser=None):
+    """
+    Complete flow: search first, then login and add to cart, all in ONE browser context.
+    Pass a long-lived browser to skip launching Chromium for every call
+    """
+    if items is not None and not items:
+        return {
+            "success": False,
+            "message": "No items to shop for"
+        }
+
+    try:
+        if browser is not None:
+            await run_shopping_flow(browser, username, password, items)
+        else:
+            async with async_playwright() as p:
+                browser = await p.chromium.launch(headless=HEADLESS, args=BROWSER_ARGS)
+                try:
+                    await run_shopping_flow(browser, username, password, items)
+                finally:
+                    await browser.close()
 
         return {
             "success": True,
@@ -500,7 +1041,7 @@ async def shopping_flow(username, password, items=None):
         }
 
     except Exception as e:
-        print(f"❌ Error: {str(e)}")
+        logger.error("❌ Error: %s", e)
         return {
             "success": False,
             "message": f"Error: {str(e)}"
@@ -513,12 +1054,15 @@ async def main():
     """
     print("=== Shufersal Automation Test ===")
 
-    username = "davidzal1992@gmail.com"
-    password = "199214David"
+    username = os.getenv("SHUFERSAL_USERNAME")
+    password = os.getenv("SHUFERSAL_PASSWORD")
+    if not username or not password:
+        raise SystemExit("Set SHUFERSAL_USERNAME and SHUFERSAL_PASSWORD (e.g. in .env) to run the test")
 
     result = await shopping_flow(username, password)
     print(f"Result: {result['message']}")
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
     asyncio.run(main())